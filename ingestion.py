@@ -1,7 +1,17 @@
 import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+import httpx
+import numpy as np
+import orjson
 import pandas as pd
-from datetime import datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 from neo4j import GraphDatabase
+from neo4j.exceptions import TransientError
 from tqdm import tqdm
 import time
  
@@ -19,42 +29,94 @@ def log_step_end(step):
     return elapsed
  
 # === Step 1: Read CSV ===
-step = "Step 1: Reading CSV"
-log_step_start(step)
 # Allow users to override the CSV location via the ``CSV_PATH`` environment
 # variable so the script is portable.
 csv_path = os.environ.get("CSV_PATH", "cleaned_data.csv")
-df = pd.read_csv(csv_path, low_memory=False)
-# Replace pandas missing values with ``None`` to avoid Neo4j errors when
-# setting properties.
-df = df.where(pd.notnull(df), None)
-print(f"📦 Read {df.shape[0]} rows and {df.shape[1]} columns from {csv_path}")
+# Bytes of CSV parsed per Arrow record batch; peak memory scales with this
+# rather than with the size of the whole file.
+csv_block_size = int(os.environ.get("CSV_BLOCK_SIZE", 64 << 20))
  
-print("\n🔎 Unique ID counts per label:")
-print(f"PurchaseOrder IDs : {df['ID'].nunique()}")
-print(f"MaterialCode      : {df['MaterialCode'].nunique()}")
-print(f"WarehouseLocation : {df['WarehouseLocation'].nunique()}")
-print(f"VendorCode        : {df['VendorCode'].nunique()}")
-print(f"BusinessUnitCode  : {df['BusinessUnitCode'].nunique()}")
+date_columns = ['PODate', 'ExpectedDeliveryStartDate', 'ExpectedDeliveryEndDate', 'ActualDeliveryDate', 'ReceivedDate']
  
-log_step_end(step)
+# Explicit column types, so the reader never has to infer them from the first
+# block and every block agrees on them. Codes and numbers-as-identifiers stay
+# strings (keeping leading zeros), and date columns are strings so
+# ``YYYYMMDD`` values are never read as integers.
+#
+# This changes what is stored: earlier versions let pandas infer types, so
+# numeric-looking codes (MRNNumber, VendorCode, ...) were stored as integers,
+# or floats where a column had gaps. MERGE does not match ``123`` to ``"123"``,
+# so load into an empty database rather than on top of a graph built by an
+# earlier version; see the README.
+COLUMN_TYPES = {
+    "ID": pa.int64(),
+    "PONumber": pa.string(), "PurchaseOrderItem": pa.string(),
+    "POQuantity": pa.float64(), "POAmount": pa.float64(), "POUOM": pa.string(),
+    "POPricePerUOM": pa.float64(), "DocumentCurrency": pa.string(), "ExchangeRate": pa.float64(),
+    "POAmountInINR": pa.float64(), "POPricePerUOMInINR": pa.float64(),
+    "PaymentTerms": pa.string(), "AmountInDocCurrency": pa.float64(),
+    "MRNNumber": pa.string(), "MRNItemNumber": pa.string(),
+    "MaterialCode": pa.string(), "MaterialGroup": pa.string(), "MaterialGroupText": pa.string(),
+    "MaterialQuantity": pa.float64(), "MovementType": pa.string(), "MaterialName": pa.string(),
+    "MaterialDescription": pa.string(),
+    "WarehouseLocation": pa.string(), "WarehouseCountry": pa.string(), "WarehouseState": pa.string(),
+    "WarehouseCity": pa.string(), "WarehousePostalCode": pa.string(),
+    "VendorCode": pa.string(), "VendorName": pa.string(), "VendorGSTIN": pa.string(),
+    "VendorPostalCode": pa.string(), "VendorCity": pa.string(), "VendorPAN": pa.string(),
+    "ContactPersonName": pa.string(), "VendorPhoneNumber": pa.string(),
+    "VendorFullAddress": pa.string(), "VendorCountry": pa.string(), "VendorCountryName": pa.string(),
+    "BusinessUnitCode": pa.string(), "BusinessUnitDescription": pa.string(), "Business": pa.string(),
+    **{col: pa.string() for col in date_columns},
+}
  
 # === Step 2: Format Date Columns ===
-step = "Step 2: Formatting Dates"
-log_step_start(step)
+# Days per month, allowing 29 for February; months 0 and 13+ allow none.
+DAYS_IN_MONTH = np.array([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31, 0])
  
-def format_date(date_str):
-    try:
-        return datetime.strptime(str(date_str), "%Y%m%d").strftime("%Y-%m-%d")
-    except (ValueError, TypeError):
-        return None
+def format_date_column(values):
+    """Rewrite ``YYYYMMDD`` strings as ``YYYY-MM-DD``; anything else becomes null.
  
-date_columns = ['PODate', 'ExpectedDeliveryStartDate', 'ExpectedDeliveryEndDate', 'ActualDeliveryDate', 'ReceivedDate']
-for col in date_columns:
-    if col in df.columns:
-        df[col] = df[col].apply(format_date)
+    Input is always ``YYYYMMDD``, so values are reformatted by slicing the
+    string and validated with integer arithmetic rather than parsed into
+    datetimes. Values that are not eight ASCII digits and impossible dates
+    (``20231345``, ``20230229``, ``00000101``) are rejected.
+    """
+    digits = pc.fill_null(
+        pc.and_(pc.equal(pc.utf8_length(values), 8), pc.ascii_is_decimal(values)), False)
+    n = pc.cast(pc.if_else(digits, values, None), pa.int64()).to_numpy()
+    with np.errstate(invalid="ignore"):
+        year, month, day = n // 10000, n // 100 % 100, n % 100
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        m = np.nan_to_num(month).astype(np.int64).clip(0, 13)
+        valid = (year >= 1) & (day >= 1) & (day <= DAYS_IN_MONTH[m] - ((m == 2) & ~leap))
+    formatted = pc.binary_join_element_wise(
+        pc.utf8_slice_codeunits(values, 0, 4), pc.utf8_slice_codeunits(values, 4, 6),
+        pc.utf8_slice_codeunits(values, 6, 8), "-")
+    return pc.if_else(pa.array(valid), formatted, None)
  
-log_step_end(step)
+def format_dates(table):
+    for col in date_columns:
+        i = table.schema.get_field_index(col)
+        if i >= 0:
+            table = table.set_column(i, col, format_date_column(table.column(i)))
+    return table
+ 
+def iter_chunks(path, block_size=csv_block_size):
+    """Stream the CSV as date-formatted DataFrames, one per Arrow record batch."""
+    reader = pacsv.open_csv(
+        path,
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        convert_options=pacsv.ConvertOptions(
+            column_types=COLUMN_TYPES,
+            strings_can_be_null=True,
+            null_values=["", "NA", "NaN"],
+        ),
+    )
+    for batch in reader:
+        # ``integer_object_nulls`` keeps integer columns with gaps as Python
+        # ints rather than promoting them to floats.
+        table = format_dates(pa.Table.from_batches([batch]))
+        yield table.to_pandas(integer_object_nulls=True)
  
 # === Step 3: Connect to Neo4j ===
 step = "Step 3: Connecting to Neo4j"
@@ -65,6 +127,129 @@ username = "neo4j"
 password = "password123"
 driver = GraphDatabase.driver(uri, auth=(username, password))
  
+# Batches are written concurrently; each worker thread lazily opens one
+# session and keeps it for the rest of the run.
+write_workers = int(os.environ.get("NEO4J_WRITE_WORKERS", 8))
+write_pool = ThreadPoolExecutor(max_workers=write_workers)
+_worker = threading.local()
+worker_sessions = []
+ 
+def worker_session():
+    session = getattr(_worker, "session", None)
+    if session is None:
+        session = _worker.session = driver.session()
+        worker_sessions.append(session)
+    return session
+ 
+def run_batch(tx, query, batch):
+    # Drain the result so nothing is buffered client-side before the commit.
+    tx.run(query, batch).consume()
+ 
+# Bulk writes go through the HTTP transactional endpoint by default: one POST
+# per batch, with the body encoded by orjson and keep-alive connections shared
+# by every worker. Set ``NEO4J_WRITE_TRANSPORT=bolt`` to write over the driver.
+write_transport = os.environ.get("NEO4J_WRITE_TRANSPORT", "http")
+http_url = os.environ.get("NEO4J_HTTP_URL", "http://localhost:7474/db/neo4j/tx/commit")
+http_client = httpx.Client(
+    auth=(username, password),
+    headers={"Content-Type": "application/json"},
+    limits=httpx.Limits(max_connections=16),
+    # Large batches can take a while to commit, but a stalled server or a
+    # half-open keep-alive connection must not hang the run forever.
+    timeout=httpx.Timeout(float(os.environ.get("NEO4J_HTTP_TIMEOUT", 300)), connect=10),
+)
+ 
+class HTTPTransientError(RuntimeError):
+    """A transient failure (e.g. a deadlock) reported by the HTTP endpoint."""
+ 
+# Transient failures are retried for up to this many seconds, matching the
+# driver's default ``max_transaction_retry_time`` for ``execute_write``.
+http_retry_time = float(os.environ.get("NEO4J_HTTP_RETRY_TIME", 30))
+ 
+def post_cypher(statements, max_retry_time=http_retry_time):
+    """Commit ``(query, parameters)`` pairs as one HTTP transaction.
+ 
+    Failures are reported in the response body rather than the status code;
+    transient ones (e.g. deadlocks between concurrent MERGEs) and connection
+    errors or timeouts are retried with jittered exponential backoff, as the
+    driver does, until ``max_retry_time`` seconds have passed.
+    """
+    body = orjson.dumps({"statements": [
+        {"statement": query, "parameters": parameters} for query, parameters in statements
+    ]}, option=orjson.OPT_SERIALIZE_NUMPY)
+    deadline = time.monotonic() + max_retry_time
+    delay = 1.0
+    while True:
+        try:
+            response = http_client.post(http_url, content=body)
+        except httpx.TransportError as exc:
+            errors = repr(exc)
+        else:
+            response.raise_for_status()
+            errors = orjson.loads(response.content)["errors"]
+            if not errors:
+                return
+            if not all(e["code"].startswith("Neo.TransientError") for e in errors):
+                raise RuntimeError(f"Cypher failed: {errors}")
+        if time.monotonic() >= deadline:
+            raise HTTPTransientError(f"Cypher failed: {errors}")
+        time.sleep(delay * random.uniform(0.8, 1.2))
+        delay *= 2
+ 
+# Number of batches committed together in one explicit transaction, trading
+# transaction heap size against BEGIN/COMMIT round trips. Within a CSV chunk a
+# worker's batches for every node label are queued together, so a group can
+# span several queries.
+batches_per_tx = int(os.environ.get("NEO4J_BATCHES_PER_TX", 4))
+ 
+def write_group(group):
+    """Commit every ``(query, batch)`` in ``group`` in a single transaction."""
+    if write_transport == "http":
+        post_cypher(group, max_retry_time=0)
+        return
+    with worker_session().begin_transaction() as tx:
+        for query, batch in group:
+            tx.run(query, batch).consume()
+        tx.commit()
+ 
+def write_batches(statements):
+    """Run each ``(query, batch)`` in order from this worker.
+ 
+    Statements are grouped into shared transactions; if a group hits a
+    transient error, only that group is retried, one batch per transaction.
+    """
+    statements = iter(statements)
+    while group := list(islice(statements, batches_per_tx)):
+        try:
+            write_group(group)
+        except (TransientError, HTTPTransientError):
+            for query, batch in group:
+                if write_transport == "http":
+                    post_cypher([(query, batch)])
+                else:
+                    worker_session().execute_write(run_batch, query, batch)
+ 
+def wait_all(futures):
+    for future in as_completed(futures):
+        future.result()
+ 
+def queue_partitioned(jobs, query, df_sub, key, columns, chunk_size):
+    """Queue ``df_sub``'s batches in ``jobs`` with every ``key`` value on one worker.
+ 
+    Rows are split by a hash of ``key`` (a column or list of columns) so that
+    concurrent transactions never lock the same node on that side of the write.
+    """
+    partition = pd.util.hash_pandas_object(df_sub[key], index=False) % write_workers
+    for p, part in df_sub.groupby(partition, sort=False):
+        jobs.setdefault(p, []).append((query, column_batches(part, columns, chunk_size)))
+ 
+def write_jobs(jobs):
+    """Write every queued partition concurrently, one worker per partition."""
+    wait_all([
+        write_pool.submit(write_batches, ((query, batch) for query, batches in queued for batch in batches))
+        for queued in jobs.values()
+    ])
+ 
 log_step_end(step)
  
 # === Step 4: Create Constraints ===
@@ -77,62 +262,227 @@ def create_constraints(tx):
     tx.run("CREATE CONSTRAINT IF NOT EXISTS FOR (w:Warehouse) REQUIRE w.WarehouseLocation IS UNIQUE")
     tx.run("CREATE CONSTRAINT IF NOT EXISTS FOR (v:Vendor) REQUIRE v.VendorCode IS UNIQUE")
     tx.run("CREATE CONSTRAINT IF NOT EXISTS FOR (b:BusinessUnit) REQUIRE b.BusinessUnitCode IS UNIQUE")
+    # ORDERS looks Materials up by MRN rather than by MaterialCode.
+    tx.run("CREATE INDEX IF NOT EXISTS FOR (m:Material) ON (m.MRNNumber, m.MRNItemNumber)")
  
 with driver.session() as session:
     session.execute_write(create_constraints)
+    # The relationship queries hint these indexes, which must be online first.
+    session.run("CALL db.awaitIndexes(300)").consume()
  
 log_step_end(step)
  
 # === Step 5: Bulk Ingest Nodes ===
-def ingest_label(session, label, id_field, columns, chunk_size=20000):
-    step = f"Ingesting {label} Nodes"
-    log_step_start(step)
- 
-    before = df.shape[0]
-    rows = df[columns].dropna(subset=[id_field]).to_dict(orient="records")
-    after = len(rows)
-    dropped = before - after
-    if dropped > 0:
-        print(f"⚠️ Dropped {dropped} rows due to missing `{id_field}`")
+def column_values(series):
+    """Convert a column for the batch payload in a single C-level pass.
  
-    query = f"""
-        UNWIND $batch AS row
-        MERGE (n:{label} {{ {id_field}: row.{id_field} }})
-        SET n += row
+    Missing values become ``None`` here, only for the columns actually sent,
+    to avoid Neo4j errors when setting properties.
     """
-    for i in tqdm(range(0, len(rows), chunk_size), desc=f"{label}"):
-        batch = rows[i:i+chunk_size]
-        session.execute_write(lambda tx: tx.run(query, batch=batch))
+    if pd.api.types.is_numeric_dtype(series.dtype) and not series.hasnans:
+        if write_transport == "http":
+            # orjson encodes numeric arrays itself, without boxing each value.
+            return np.ascontiguousarray(series.to_numpy())
+        return series.to_numpy().tolist()
+    # Arrow's list conversion beats pandas' for object/string columns and
+    # maps NaN to ``None`` as it goes.
+    return pa.array(series, from_pandas=True).to_pylist()
  
-    return log_step_end(step)
+def column_batches(df_sub, columns, chunk_size):
+    """Yield ``{column: [values...]}`` slices of at most ``chunk_size`` rows.
  
-# === Step 6: Ingest Nodes ===
-ingestion_times = {}
-with driver.session() as session:
-    ingestion_times["PurchaseOrder"] = ingest_label(session, "PurchaseOrder", "ID", [
+    Sending one list per column rather than one map per row avoids building a
+    dict per row and repeating every key string in the Bolt payload.
+    """
+    payload = {c: column_values(df_sub[c]) for c in columns}
+    for i in range(0, df_sub.shape[0], chunk_size):
+        yield {c: payload[c][i:i+chunk_size] for c in columns}
+ 
+def unwind_query(columns, body):
+    """Run ``body`` once per row of a column-wise batch, one variable per column."""
+    bindings = ", ".join(f"${c}[i] AS {c}" for c in columns)
+    return f"""
+        UNWIND range(0, size(${columns[0]}) - 1) AS i
+        WITH {bindings}
+        {body}
+    """
+ 
+# With ``NEO4J_IMPORT_DIR`` pointing at the server's import directory, Steps 6
+# and 8 hand the bulk work to Neo4j: the cleaned CSV is written there once and
+# read back with LOAD CSV, so rows are parsed next to the storage engine
+# rather than sent over the wire batch by batch.
+import_dir = os.environ.get("NEO4J_IMPORT_DIR")
+import_file = "cleaned_ingest.csv"
+ 
+# LOAD CSV reads every field as a string; cast back to the declared types.
+CSV_CASTS = {pa.int64(): "toInteger", pa.float64(): "toFloat"}
+ 
+def load_csv_query(columns, required, body, rows_per_tx=20000):
+    """Run ``body`` once per row of the cleaned CSV with ``required`` set."""
+    bindings = ", ".join(
+        f"{CSV_CASTS[COLUMN_TYPES[c]]}(row.{c}) AS {c}"
+        if COLUMN_TYPES.get(c) in CSV_CASTS else f"row.{c} AS {c}"
+        for c in columns
+    )
+    filters = " AND ".join(f"{c} IS NOT NULL" for c in required)
+    return f"""
+        LOAD CSV WITH HEADERS FROM $url AS row
+        CALL {{
+            WITH row
+            WITH {bindings}
+            WHERE {filters}
+            {body}
+        }} IN TRANSACTIONS OF {rows_per_tx} ROWS
+    """
+ 
+def node_query_body(label, id_field, columns, mode="merge"):
+    set_clause = ", ".join(f"n.{c} = {c}" for c in columns if c != id_field)
+    return f"""
+        {"CREATE" if mode == "create" else "MERGE"} (n:{label} {{ {id_field}: {id_field} }})
+        SET {set_clause}
+    """
+ 
+def ingest_label(label, id_field, columns, chunk_df, jobs, mode="merge", chunk_size=20000):
+    """Queue one CSV chunk's worth of ``label`` nodes in ``jobs``.
+ 
+    ``mode="create"`` skips the MERGE lookup and is only safe for IDs that are
+    not yet in the graph; the unique constraint still rejects duplicates.
+    """
+    df_sub = chunk_df[columns].dropna(subset=[id_field])
+    after = df_sub.shape[0]
+ 
+    # Only the last row per ID is sent: repeated rows would each cost a MERGE
+    # probe and leave the final properties down to batch ordering.
+    df_sub = df_sub.drop_duplicates(subset=[id_field], keep="last")
+    counts = node_row_counts.setdefault(label, [0, 0, 0])
+    counts[0] += chunk_df.shape[0] - after
+    counts[1] += after
+    counts[2] += df_sub.shape[0]
+ 
+    queue_partitioned(jobs, NODE_QUERIES[label, mode], df_sub, id_field, columns, chunk_size)
+ 
+NODE_SPECS = [
+    ("PurchaseOrder", "ID", [
         "ID", "PONumber", "PurchaseOrderItem", "POQuantity", "POAmount", "POUOM",
         "POPricePerUOM", "DocumentCurrency", "ExchangeRate", "POAmountInINR",
         "POPricePerUOMInINR", "PODate", "PaymentTerms", "ExpectedDeliveryStartDate",
         "ExpectedDeliveryEndDate", "ActualDeliveryDate", "ReceivedDate", "AmountInDocCurrency",
         "MRNNumber", "MRNItemNumber", "WarehouseLocation", "VendorCode", "BusinessUnitCode"
-    ])
-    ingestion_times["Material"] = ingest_label(session, "Material", "MaterialCode", [
+    ]),
+    ("Material", "MaterialCode", [
         "MaterialCode", "MRNNumber", "MRNItemNumber", "MaterialGroup", "MaterialGroupText",
         "MaterialQuantity", "MovementType", "MaterialName", "MaterialDescription",
         "WarehouseLocation", "VendorCode"
-    ])
-    ingestion_times["Warehouse"] = ingest_label(session, "Warehouse", "WarehouseLocation", [
+    ]),
+    ("Warehouse", "WarehouseLocation", [
         "WarehouseLocation", "WarehouseCountry", "WarehouseState", "WarehouseCity",
         "WarehousePostalCode", "BusinessUnitCode"
-    ])
-    ingestion_times["Vendor"] = ingest_label(session, "Vendor", "VendorCode", [
+    ]),
+    ("Vendor", "VendorCode", [
         "VendorCode", "VendorName", "VendorGSTIN", "VendorPostalCode", "VendorCity", "VendorPAN",
         "ContactPersonName", "VendorPhoneNumber", "VendorFullAddress", "VendorCountry",
         "VendorCountryName", "BusinessUnitCode"
-    ])
-    ingestion_times["BusinessUnit"] = ingest_label(session, "BusinessUnit", "BusinessUnitCode", [
+    ]),
+    ("BusinessUnit", "BusinessUnitCode", [
         "BusinessUnitCode", "BusinessUnitDescription", "Business"
-    ])
+    ]),
+]
+ 
+# Each label's Cypher is specialised to its known columns once, up front, so
+# every chunk reuses the same explicit ``SET n.<col> = ...`` query text.
+NODE_QUERIES = {
+    (label, mode): unwind_query(columns, node_query_body(label, id_field, columns, mode))
+    for label, id_field, columns in NODE_SPECS
+    for mode in ("create", "merge")
+}
+ 
+# === Step 6: Ingest Nodes ===
+step = "Step 6: Ingesting Nodes"
+log_step_start(step)
+ 
+# Node write time per label, or for all labels together when they share
+# transactions.
+ingestion_times = {}
+# Rows dropped for a missing ID, rows with an ID and rows actually sent after
+# de-duplication, per label.
+node_row_counts = {}
+# Unique IDs are tracked incrementally since the full frame is never in memory.
+unique_ids = {"ID": set(), "MaterialCode": set(), "WarehouseLocation": set(),
+              "VendorCode": set(), "BusinessUnitCode": set()}
+ 
+def track_unique_ids(chunk_df):
+    # ``unique()`` collapses each column in C first, so the Python sets only
+    # see each value once per chunk.
+    for field, values in chunk_df[list(unique_ids)].items():
+        unique_ids[field].update(values.dropna().unique())
+
+# Labels that are empty before the load are filled with CREATE the first time
+# each ID is seen; only IDs repeated in later chunks go through MERGE. Set
+# ``INGEST_MODE=merge`` to always MERGE.
+def count_label(tx, label):
+    return tx.run(f"MATCH (n:{label}) RETURN count(n) AS count").single()["count"]
+ 
+total_rows = 0
+if import_dir:
+    export_path = os.path.join(import_dir, import_file)
+    for n, chunk_df in enumerate(tqdm(iter_chunks(csv_path), desc="CSV chunks", unit="chunk")):
+        total_rows += chunk_df.shape[0]
+        track_unique_ids(chunk_df)
+        chunk_df.to_csv(export_path, mode="w" if n == 0 else "a", header=n == 0, index=False)
+    # An empty CSV yields no chunks, so there may be no export to load.
+    if total_rows:
+        with driver.session() as session:
+            for label, id_field, columns in NODE_SPECS:
+                start = time.time()
+                query = load_csv_query(columns, [id_field], node_query_body(label, id_field, columns))
+                session.run(query, url=f"file:///{import_file}").consume()
+                ingestion_times[label] = time.time() - start
+else:
+    create_labels = set()
+    if os.environ.get("INGEST_MODE", "auto") != "merge":
+        with driver.session() as session:
+            for label, _, _ in NODE_SPECS:
+                if session.execute_read(count_label, label) == 0:
+                    create_labels.add(label)
+ 
+    ingestion_times["All labels"] = 0.0
+    for chunk_df in tqdm(iter_chunks(csv_path), desc="CSV chunks", unit="chunk"):
+        start = time.time()
+        total_rows += chunk_df.shape[0]
+        jobs = {}
+        for label, id_field, columns in NODE_SPECS:
+            if label in create_labels:
+                # One set lookup per distinct ID, mapped back to rows in C.
+                seen = unique_ids[id_field]
+                ids = chunk_df[id_field]
+                is_new = ids.isin([v for v in ids.dropna().unique() if v not in seen])
+                ingest_label(label, id_field, columns, chunk_df[is_new], jobs, mode="create")
+                merge_df = chunk_df[~is_new]
+            else:
+                merge_df = chunk_df
+            ingest_label(label, id_field, columns, merge_df, jobs)
+        write_jobs(jobs)
+        ingestion_times["All labels"] += time.time() - start
+        track_unique_ids(chunk_df)
+ 
+print(f"📦 Read {total_rows} rows from {csv_path} in {csv_block_size / (1 << 20):g} MiB blocks")
+ 
+print("\n🔎 Unique ID counts per label:")
+for field, seen in unique_ids.items():
+    print(f"{field:<18}: {len(seen)}")
+ 
+for label, id_field, _ in NODE_SPECS:
+    dropped = node_row_counts.get(label, [0])[0]
+    if dropped > 0:
+        print(f"⚠️ {label}: dropped {dropped} rows due to missing `{id_field}`")
+ 
+if node_row_counts:
+    print("\n🧹 Node rows sent after de-duplication:")
+    for label, (_, rows_in, rows_sent) in node_row_counts.items():
+        ratio = rows_in / rows_sent if rows_sent else 0.0
+        print(f"  {label:<15}: {rows_in} -> {rows_sent} ({ratio:.1f}x)")
+ 
+log_step_end(step)
  
 # === Step 7: Confirm Node Counts ===
 step = "Step 7: Confirming Node Counts"
@@ -158,72 +508,174 @@ with driver.session() as session:
 log_step_end(step)
  
 # === Step 8: Create Relationships ===
-def create_relationship(session, rel_label, columns, query, chunk_size=20000):
-    """Create relationships in batches driven by the source DataFrame."""
-    step = f"Step 8: Creating {rel_label} Relationships"
-    log_step_start(step)
-    rows = df[columns].dropna(subset=columns).drop_duplicates().to_dict("records")
-    for i in tqdm(range(0, len(rows), chunk_size), desc=rel_label):
-        batch = rows[i:i + chunk_size]
-        session.execute_write(lambda tx: tx.run(query, batch=batch))
-    log_step_end(step)
+def create_relationship(rel_label, columns, query, chunk_df, jobs, chunk_size=20000):
+    """Queue one CSV chunk's worth of relationships in ``jobs``."""
+    df_sub = chunk_df[columns].dropna(subset=columns).drop_duplicates()
+    sent = sent_pairs.get(rel_label)
+    if sent is not None:
+        pairs = pd.MultiIndex.from_frame(df_sub)
+        is_new = ~pairs.isin(sent)
+        df_sub = df_sub[is_new]
+        sent_pairs[rel_label] = sent.append(pairs[is_new])
+    if df_sub.empty:
+        return
+    # Every spec's target is its low-cardinality end (a Material, Warehouse,
+    # Vendor or BusinessUnit shared by many sources), so each target node is
+    # owned by one worker. A PurchaseOrder has one target per type, so the
+    # source side cannot conflict either.
+    queue_partitioned(jobs, query, df_sub, columns[1:], columns, chunk_size)
 
-with driver.session() as session:
-    create_relationship(session, "ORDERS", ["ID", "MRNNumber", "MRNItemNumber"], """
-        UNWIND $batch AS row
-        MATCH (po:PurchaseOrder {ID: row.ID})
-        MATCH (m:Material {MRNNumber: row.MRNNumber, MRNItemNumber: row.MRNItemNumber})
+# Pairs already written by earlier chunks, for relationships between
+# low-cardinality nodes whose pairs repeat in nearly every chunk. Pairs keyed
+# by PurchaseOrder ID are near-unique per row, so remembering them would only
+# cost memory. Each is a MultiIndex so a chunk is filtered with one ``isin``.
+sent_pairs = {}
+ 
+RELATIONSHIP_SPECS = [
+    ("ORDERS", ["ID", "MRNNumber", "MRNItemNumber"], """
+        MATCH (po:PurchaseOrder {ID: ID})
+        USING INDEX po:PurchaseOrder(ID)
+        MATCH (m:Material {MRNNumber: MRNNumber, MRNItemNumber: MRNItemNumber})
+        USING INDEX m:Material(MRNNumber, MRNItemNumber)
         MERGE (po)-[:ORDERS]->(m)
-    """)
-
-    create_relationship(session, "DELIVERED_TO", ["ID", "WarehouseLocation"], """
-        UNWIND $batch AS row
-        MATCH (po:PurchaseOrder {ID: row.ID})
-        MATCH (w:Warehouse {WarehouseLocation: row.WarehouseLocation})
+    """),
+    ("DELIVERED_TO", ["ID", "WarehouseLocation"], """
+        MATCH (po:PurchaseOrder {ID: ID})
+        USING INDEX po:PurchaseOrder(ID)
+        MATCH (w:Warehouse {WarehouseLocation: WarehouseLocation})
+        USING INDEX w:Warehouse(WarehouseLocation)
         MERGE (po)-[:DELIVERED_TO]->(w)
-    """)
-
-    create_relationship(session, "PROCURED_FROM", ["ID", "VendorCode"], """
-        UNWIND $batch AS row
-        MATCH (po:PurchaseOrder {ID: row.ID})
-        MATCH (v:Vendor {VendorCode: row.VendorCode})
+    """),
+    ("PROCURED_FROM", ["ID", "VendorCode"], """
+        MATCH (po:PurchaseOrder {ID: ID})
+        USING INDEX po:PurchaseOrder(ID)
+        MATCH (v:Vendor {VendorCode: VendorCode})
+        USING INDEX v:Vendor(VendorCode)
         MERGE (po)-[:PROCURED_FROM]->(v)
-    """)
-
-    create_relationship(session, "RAISED_BY", ["ID", "BusinessUnitCode"], """
-        UNWIND $batch AS row
-        MATCH (po:PurchaseOrder {ID: row.ID})
-        MATCH (bu:BusinessUnit {BusinessUnitCode: row.BusinessUnitCode})
+    """),
+    ("RAISED_BY", ["ID", "BusinessUnitCode"], """
+        MATCH (po:PurchaseOrder {ID: ID})
+        USING INDEX po:PurchaseOrder(ID)
+        MATCH (bu:BusinessUnit {BusinessUnitCode: BusinessUnitCode})
+        USING INDEX bu:BusinessUnit(BusinessUnitCode)
         MERGE (po)-[:RAISED_BY]->(bu)
-    """)
-
-    create_relationship(session, "STORED_IN", ["MaterialCode", "WarehouseLocation"], """
-        UNWIND $batch AS row
-        MATCH (m:Material {MaterialCode: row.MaterialCode})
-        MATCH (w:Warehouse {WarehouseLocation: row.WarehouseLocation})
+    """),
+    ("STORED_IN", ["MaterialCode", "WarehouseLocation"], """
+        MATCH (m:Material {MaterialCode: MaterialCode})
+        USING INDEX m:Material(MaterialCode)
+        MATCH (w:Warehouse {WarehouseLocation: WarehouseLocation})
+        USING INDEX w:Warehouse(WarehouseLocation)
         MERGE (m)-[:STORED_IN]->(w)
-    """)
-
-    create_relationship(session, "SUPPLIED_BY", ["MaterialCode", "VendorCode"], """
-        UNWIND $batch AS row
-        MATCH (m:Material {MaterialCode: row.MaterialCode})
-        MATCH (v:Vendor {VendorCode: row.VendorCode})
+    """),
+    ("SUPPLIED_BY", ["MaterialCode", "VendorCode"], """
+        MATCH (m:Material {MaterialCode: MaterialCode})
+        USING INDEX m:Material(MaterialCode)
+        MATCH (v:Vendor {VendorCode: VendorCode})
+        USING INDEX v:Vendor(VendorCode)
         MERGE (m)-[:SUPPLIED_BY]->(v)
-    """)
-
-    create_relationship(session, "SUPPLIES_TO", ["VendorCode", "BusinessUnitCode"], """
-        UNWIND $batch AS row
-        MATCH (v:Vendor {VendorCode: row.VendorCode})
-        MATCH (bu:BusinessUnit {BusinessUnitCode: row.BusinessUnitCode})
+    """),
+    ("SUPPLIES_TO", ["VendorCode", "BusinessUnitCode"], """
+        MATCH (v:Vendor {VendorCode: VendorCode})
+        USING INDEX v:Vendor(VendorCode)
+        MATCH (bu:BusinessUnit {BusinessUnitCode: BusinessUnitCode})
+        USING INDEX bu:BusinessUnit(BusinessUnitCode)
         MERGE (v)-[:SUPPLIES_TO]->(bu)
-    """)
-
-    create_relationship(session, "BELONGS_TO", ["WarehouseLocation", "BusinessUnitCode"], """
-        UNWIND $batch AS row
-        MATCH (w:Warehouse {WarehouseLocation: row.WarehouseLocation})
-        MATCH (bu:BusinessUnit {BusinessUnitCode: row.BusinessUnitCode})
+    """),
+    ("BELONGS_TO", ["WarehouseLocation", "BusinessUnitCode"], """
+        MATCH (w:Warehouse {WarehouseLocation: WarehouseLocation})
+        USING INDEX w:Warehouse(WarehouseLocation)
+        MATCH (bu:BusinessUnit {BusinessUnitCode: BusinessUnitCode})
+        USING INDEX bu:BusinessUnit(BusinessUnitCode)
         MERGE (w)-[:BELONGS_TO]->(bu)
-    """)
+    """),
+]
+
+# When APOC is installed, relationships out of PurchaseOrder are joined inside
+# Neo4j from the properties already stored on the nodes, so no IDs have to be
+# sent back over the wire. This is only exact when every CSV row has its own
+# PurchaseOrder ID (checked against the Step 6 counts), since a node keeps
+# just its last row's properties; Material, Warehouse and Vendor are always
+# linked from the CSV for the same reason.
+#
+# Batches run one at a time: every target is shared by many PurchaseOrders
+# (a Material by every PO that orders it, a Warehouse, Vendor or BusinessUnit
+# by far more), so parallel batches would MERGE into overlapping nodes in
+# arbitrary order and could deadlock.
+SERVER_SIDE_RELATIONSHIPS = {
+    "ORDERS": """
+        MATCH (m:Material {MRNNumber: po.MRNNumber, MRNItemNumber: po.MRNItemNumber})
+        USING INDEX m:Material(MRNNumber, MRNItemNumber)
+        MERGE (po)-[:ORDERS]->(m)
+    """,
+    "DELIVERED_TO": """
+        MATCH (w:Warehouse {WarehouseLocation: po.WarehouseLocation})
+        USING INDEX w:Warehouse(WarehouseLocation)
+        MERGE (po)-[:DELIVERED_TO]->(w)
+    """,
+    "PROCURED_FROM": """
+        MATCH (v:Vendor {VendorCode: po.VendorCode})
+        USING INDEX v:Vendor(VendorCode)
+        MERGE (po)-[:PROCURED_FROM]->(v)
+    """,
+    "RAISED_BY": """
+        MATCH (bu:BusinessUnit {BusinessUnitCode: po.BusinessUnitCode})
+        USING INDEX bu:BusinessUnit(BusinessUnitCode)
+        MERGE (po)-[:RAISED_BY]->(bu)
+    """,
+}
+ 
+step = "Step 8: Creating Relationships"
+log_step_start(step)
+if import_dir:
+    if total_rows:
+        with driver.session() as session:
+            for rel_label, columns, query in tqdm(RELATIONSHIP_SPECS, desc="LOAD CSV"):
+                session.run(load_csv_query(columns, columns, query), url=f"file:///{import_file}").consume()
+    # Don't leave a full copy of the data behind in the server's import directory.
+    if os.path.exists(export_path):
+        os.remove(export_path)
+else:
+    with driver.session() as session:
+        apoc_available = session.run("""
+            SHOW PROCEDURES YIELD name
+            WHERE name = 'apoc.periodic.iterate'
+            RETURN count(name) AS count
+        """).single()["count"] > 0
+        one_row_per_po = total_rows == len(unique_ids["ID"])
+        server_side = apoc_available and one_row_per_po
+        if server_side:
+            for rel_label, query in tqdm(SERVER_SIDE_RELATIONSHIPS.items(), desc="apoc.periodic.iterate"):
+                result = session.run("""
+                    CALL apoc.periodic.iterate(
+                        'MATCH (po:PurchaseOrder) RETURN po', $query,
+                        {batchSize: 20000, parallel: false, retries: 3}
+                    ) YIELD failedBatches, errorMessages
+                    RETURN failedBatches, errorMessages
+                """, query=query).single()
+                if result["failedBatches"]:
+                    raise RuntimeError(f"{rel_label}: {result['failedBatches']} batches failed: "
+                                       f"{result['errorMessages']}")
+        elif apoc_available:
+            print("⚠️ Not every CSV row has its own PurchaseOrder ID; creating every relationship from the CSV")
+        else:
+            print("⚠️ APOC not available; creating every relationship from the CSV")
+ 
+    client_specs = [(rel_label, columns, unwind_query(columns, query))
+                    for rel_label, columns, query in RELATIONSHIP_SPECS
+                    if not (server_side and rel_label in SERVER_SIDE_RELATIONSHIPS)]
+    sent_pairs.update({rel_label: pd.MultiIndex.from_arrays([[]] * len(columns), names=columns)
+                       for rel_label, columns, _ in client_specs if "ID" not in columns})
+    # Second pass over the CSV: every node now exists, so each chunk can be
+    # linked independently. MERGE is idempotent, so pairs repeated across
+    # chunks are safe. Types are written one after another: each is
+    # partitioned on its own target, so two types in flight at once could
+    # still lock the same PurchaseOrder from different workers.
+    for chunk_df in tqdm(iter_chunks(csv_path), desc="CSV chunks", unit="chunk"):
+        for rel_label, columns, query in client_specs:
+            jobs = {}
+            create_relationship(rel_label, columns, query, chunk_df, jobs)
+            write_jobs(jobs)
+log_step_end(step)
 
 # === Step 9: Confirm Relationship Counts ===
 step = "Step 9: Confirming Relationship Counts"
@@ -247,6 +699,10 @@ with driver.session() as session:
 
 log_step_end(step)
 
+write_pool.shutdown()
+http_client.close()
+for session in worker_sessions:
+    session.close()
 driver.close()
 
 # === Final Summary ===
@@ -254,6 +710,6 @@ total_time = time.time() - overall_start
 print("\n🎉 All steps completed successfully!")
 print(f"🕒 Total time elapsed: {total_time:.2f} seconds")
 
-print("\n📊 Ingestion Time per Node Type:")
+print("\n📊 Node Ingestion Time:")
 for label, seconds in ingestion_times.items():
     print(f"  {label:<15}: {seconds:.2f} sec")